@@ -4,7 +4,7 @@ Flask Image Processing Server for ESP32-CAM
 Handles real-time image processing and sends results to main website
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import cv2
 import numpy as np
 import base64
@@ -12,6 +12,16 @@ import requests
 import json
 import time
 import logging
+import cProfile
+import functools
+import hmac
+import marshal
+import math
+import pstats
+import random
+import sys
+import threading
+import zlib
 from datetime import datetime
 import os
 from werkzeug.utils import secure_filename
@@ -35,6 +45,476 @@ KNOWN_FACES = {}
 FACE_TRAINING_DATA = {}
 TRAINING_MODE = False
 
+# Gallery storage format: "float" keeps raw float64 encodings, "float16" keeps
+# unit-normalized float16 vectors and "int8" keeps int8 vectors with per-block scales
+ENCODING_STORAGE_MODES = ('float', 'float16', 'int8')
+FACE_ENCODING_STORAGE = os.getenv('FACE_ENCODING_STORAGE', 'float').lower()
+if FACE_ENCODING_STORAGE not in ENCODING_STORAGE_MODES:
+    logger.warning(f"Unknown FACE_ENCODING_STORAGE '{FACE_ENCODING_STORAGE}', falling back to float")
+    FACE_ENCODING_STORAGE = 'float'
+
+# Feature layout of ImageProcessor.extract_face_features
+FACE_INTENSITY_BINS = 32
+FACE_EDGE_BINS = 16
+FACE_FEATURE_SIZE = FACE_INTENSITY_BINS + FACE_EDGE_BINS
+FACE_FEATURE_BLOCKS = ((0, FACE_INTENSITY_BINS), (FACE_INTENSITY_BINS, FACE_FEATURE_SIZE))
+
+def encoding_blocks(mode, dim):
+    """Column ranges sharing one quantization scale
+
+    int8 scales each feature block separately, since the edge histogram's first
+    bin would otherwise swamp the intensity bins with a single per-vector scale.
+    """
+    if dim != FACE_FEATURE_SIZE:
+        raise ValueError(f"Face encoding has {dim} values, expected {FACE_FEATURE_SIZE}")
+    if mode == 'int8':
+        return FACE_FEATURE_BLOCKS
+    return ((0, dim),)
+
+def encoding_crc(encoding):
+    """Checksum of a float encoding as it round-trips through known_faces.json"""
+    return zlib.crc32(np.asarray(encoding, dtype=np.float64).tobytes())
+
+class QuantizedGallery:
+    """Every known face encoding packed into one quantized matrix
+
+    Rows are grouped by person (`counts[p]` consecutive rows for `person_ids[p]`)
+    and block b of a row is stored as `values[i, block] * scales[i, b] ~= encoding[block]`,
+    together with the L2 norm of that reconstruction. Scoring multiplies chunks of
+    rows by a block-diagonal probe matrix, so the only float copy of the rows is
+    one cache-sized chunk, and only the per-row dot products are rescaled.
+
+    The float encodings in known_faces.json stay the source of truth: each row
+    records the index and checksum of its float row on disk, and rows trained
+    since the last save keep their float originals in `unsaved` until written.
+    """
+
+    SCORE_CHUNK_ROWS = 2048
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.blocks = encoding_blocks(mode, FACE_FEATURE_SIZE)
+        self._block_sizes = [end - start for start, end in self.blocks]
+        self.load([])
+
+    def load(self, people):
+        """Replace the gallery with (person_id, threshold, encodings) as stored on disk"""
+        people = [(person_id, threshold, self._as_rows(encodings))
+                  for person_id, threshold, encodings in people if len(encodings)]
+        rows = [encodings for _, _, encodings in people]
+        rows = np.concatenate(rows) if rows else np.zeros((0, FACE_FEATURE_SIZE))
+
+        self.person_ids = [person_id for person_id, _, _ in people]
+        self.person_index = {person_id: p for p, person_id in enumerate(self.person_ids)}
+        self.thresholds = np.array([threshold for _, threshold, _ in people], dtype=np.float32)
+        self.counts = np.array([len(encodings) for _, _, encodings in people], dtype=np.int64)
+        self.values, self.scales, self.norms = self._quantize(rows)
+        self.saved_index = np.concatenate(
+            [np.arange(count, dtype=np.int32) for count in self.counts] or [np.zeros(0, dtype=np.int32)]
+        )
+        self.saved_crc = np.array([encoding_crc(row) for row in rows], dtype=np.uint32)
+        self.unsaved = {}
+        self._update_starts()
+
+    def _as_rows(self, encodings):
+        rows = np.asarray(encodings, dtype=np.float64)
+        if rows.ndim == 1:
+            rows = rows[np.newaxis, :]
+        if rows.ndim != 2 or rows.shape[1] != FACE_FEATURE_SIZE:
+            raise ValueError(f"Face encoding has {rows.shape[-1]} values, expected {FACE_FEATURE_SIZE}")
+        return rows
+
+    def _quantize(self, rows):
+        dtype = np.float16 if self.mode == 'float16' else np.int8
+        values = np.zeros(rows.shape, dtype=dtype)
+        scales = np.ones((len(rows), len(self.blocks)), dtype=np.float32)
+        for b, (start, end) in enumerate(self.blocks):
+            block = rows[:, start:end]
+            if self.mode == 'float16':
+                scale = np.linalg.norm(block, axis=1)
+            else:
+                scale = np.max(np.abs(block), axis=1) / 127
+            scales[:, b] = np.where(scale > 0, scale, 1.0)
+            scaled = block / scales[:, b:b + 1]
+            values[:, start:end] = scaled if self.mode == 'float16' else np.clip(np.rint(scaled), -127, 127)
+        # Norm of the reconstruction rather than the original, so the distance
+        # expansion in person_similarities() does not cancel against quantization error
+        norms = np.linalg.norm(values.astype(np.float64) * self._scale_columns(scales), axis=1)
+        return values, scales, norms
+
+    def _scale_columns(self, scales):
+        """Expand per-block scales to per-column scales"""
+        return np.repeat(scales.astype(np.float64), self._block_sizes, axis=1)
+
+    def _update_starts(self):
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+
+    def _rows(self, person_id):
+        p = self.person_index[person_id]
+        return slice(int(self.starts[p]), int(self.starts[p] + self.counts[p]))
+
+    def count(self, person_id):
+        p = self.person_index.get(person_id)
+        return 0 if p is None else int(self.counts[p])
+
+    def add(self, person_id, threshold, encodings):
+        """Add newly trained encodings for a person, keeping their float originals until saved"""
+        rows = self._as_rows(encodings)
+        values, scales, norms = self._quantize(rows)
+        if person_id not in self.person_index:
+            self.person_index[person_id] = len(self.person_ids)
+            self.person_ids.append(person_id)
+            self.thresholds = np.append(self.thresholds, np.float32(threshold))
+            self.counts = np.append(self.counts, 0)
+            self._update_starts()
+
+        position = self._rows(person_id).stop
+        self.values = np.insert(self.values, position, values, axis=0)
+        self.scales = np.insert(self.scales, position, scales, axis=0)
+        self.norms = np.insert(self.norms, position, norms)
+        self.saved_index = np.insert(self.saved_index, position, np.full(len(rows), -1, dtype=np.int32))
+        self.saved_crc = np.insert(self.saved_crc, position, np.zeros(len(rows), dtype=np.uint32))
+        self.unsaved.setdefault(person_id, []).extend(rows)
+        self.counts[self.person_index[person_id]] += len(rows)
+        self._update_starts()
+
+    def trim(self, person_id, limit):
+        """Drop a person's oldest encodings beyond `limit`"""
+        rows = self._rows(person_id)
+        drop = (rows.stop - rows.start) - limit
+        if drop <= 0:
+            return
+        # Unsaved rows always come after saved ones
+        saved = int(np.count_nonzero(self.saved_index[rows] >= 0))
+        if drop > saved:
+            self.unsaved[person_id] = self.unsaved[person_id][drop - saved:]
+
+        dropped = np.arange(rows.start, rows.start + drop)
+        self.values = np.delete(self.values, dropped, axis=0)
+        self.scales = np.delete(self.scales, dropped, axis=0)
+        self.norms = np.delete(self.norms, dropped)
+        self.saved_index = np.delete(self.saved_index, dropped)
+        self.saved_crc = np.delete(self.saved_crc, dropped)
+        self.counts[self.person_index[person_id]] -= drop
+        self._update_starts()
+
+    def row_index(self, person_id, index):
+        return self._rows(person_id).start + index
+
+    def float_rows(self, person_id, saved_rows):
+        """Float originals of a person's rows, given the rows currently in known_faces.json
+
+        Raises ValueError if the file no longer holds the rows this gallery was built from.
+        """
+        if person_id not in self.person_index:
+            return []
+        rows = []
+        for index, crc in zip(self.saved_index[self._rows(person_id)], self.saved_crc[self._rows(person_id)]):
+            if index < 0:
+                continue
+            if index >= len(saved_rows) or encoding_crc(saved_rows[index]) != crc:
+                raise ValueError(f"known_faces.json no longer holds the float encodings of {person_id}")
+            rows.append(saved_rows[index])
+        return rows + self.unsaved.get(person_id, [])
+
+    def mark_saved(self, person_id, rows):
+        """Record that `rows` (from float_rows) are now the person's rows on disk"""
+        if person_id not in self.person_index:
+            return
+        self.saved_index[self._rows(person_id)] = np.arange(len(rows), dtype=np.int32)
+        self.saved_crc[self._rows(person_id)] = [encoding_crc(row) for row in rows]
+        self.unsaved.pop(person_id, None)
+
+    def person_similarities(self, features, excluded_row=None):
+        """Best combined cosine/Euclidean similarity of features per person, in person_ids order"""
+        similarities = np.zeros(len(self.person_ids), dtype=np.float64)
+        features = np.asarray(features, dtype=np.float32)
+        feature_norm = np.linalg.norm(features.astype(np.float64))
+        if len(self.norms) == 0 or feature_norm == 0:
+            return similarities
+
+        probe = np.zeros((FACE_FEATURE_SIZE, len(self.blocks)), dtype=np.float32)
+        for b, (start, end) in enumerate(self.blocks):
+            probe[start:end, b] = features[start:end]
+
+        # Dot products against the raw encodings, recovered from the quantized rows
+        dots = np.empty(len(self.norms), dtype=np.float64)
+        for start in range(0, len(self.norms), self.SCORE_CHUNK_ROWS):
+            end = start + self.SCORE_CHUNK_ROWS
+            dots[start:end] = np.einsum('ib,ib->i', self.values[start:end] @ probe,
+                                        self.scales[start:end], dtype=np.float64)
+
+        valid = self.norms > 0
+        norms = np.where(valid, self.norms, 1.0)
+        cosine_similarity = dots / (feature_norm * norms)
+        squared_distance = np.maximum(feature_norm ** 2 + norms ** 2 - 2 * dots, 0)
+        euclidean_similarity = 1 / (1 + np.sqrt(squared_distance) / 1000)
+        row_similarities = np.where(valid, (cosine_similarity + euclidean_similarity) / 2, -np.inf)
+        if excluded_row is not None:
+            row_similarities[excluded_row] = -np.inf
+
+        similarities = np.maximum.reduceat(row_similarities, self.starts)
+        similarities[np.isneginf(similarities)] = 0
+        return similarities
+
+    def memory_bytes(self):
+        """Memory held by the gallery, excluding person id strings shared with KNOWN_FACES"""
+        arrays = (self.values, self.scales, self.norms, self.saved_index, self.saved_crc,
+                  self.thresholds, self.counts, self.starts)
+        total = sum(sys.getsizeof(array) for array in arrays)
+        total += sys.getsizeof(self.person_ids) + sys.getsizeof(self.person_index) + sys.getsizeof(self.unsaved)
+        for rows in self.unsaved.values():
+            total += sys.getsizeof(rows) + sum(sys.getsizeof(row) for row in rows)
+        return total
+
+def float_gallery_memory_bytes(gallery):
+    """Memory held by float encoding lists as stored in KNOWN_FACES"""
+    return sum(
+        sys.getsizeof(encodings) + sum(sys.getsizeof(encoding) for encoding in encodings)
+        for encodings in gallery.values()
+    )
+
+# Packed gallery used instead of per-person encoding lists when quantized storage is enabled
+QUANTIZED_GALLERY = QuantizedGallery(FACE_ENCODING_STORAGE) if FACE_ENCODING_STORAGE != 'float' else None
+
+def face_encoding_count(person_id):
+    if QUANTIZED_GALLERY is not None:
+        return QUANTIZED_GALLERY.count(person_id)
+    return len(KNOWN_FACES[person_id].get("face_encodings", []))
+
+def add_face_encoding(person_id, encoding, limit):
+    """Store a newly trained encoding, keeping at most `limit` per person"""
+    if QUANTIZED_GALLERY is not None:
+        QUANTIZED_GALLERY.add(person_id, KNOWN_FACES[person_id]["confidence_threshold"], [encoding])
+        QUANTIZED_GALLERY.trim(person_id, limit)
+        return
+
+    encodings = KNOWN_FACES[person_id].setdefault("face_encodings", [])
+    encodings.append(encoding)
+    if len(encodings) > limit:
+        KNOWN_FACES[person_id]["face_encodings"] = encodings[-limit:]
+
+def read_saved_float_encodings():
+    """Float encodings per person as stored in known_faces.json"""
+    if not os.path.exists("known_faces.json"):
+        return {}
+    with open("known_faces.json", "r") as f:
+        data = json.load(f)
+    return {
+        person_id: [np.array(encoding, dtype=np.float64) for encoding in person_data["face_encodings"]]
+        for person_id, person_data in data.items()
+    }
+
+# Request profiling (disabled unless an admin token is configured)
+PROFILING_ADMIN_TOKEN = os.getenv('PROFILING_ADMIN_TOKEN', '')
+
+class _ProfileStage:
+    """Times one stage of a sampled request, attributing self time to its stack path"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._local.stack.append([self.name, time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stack = self.profiler._local.stack
+        path = ";".join(frame[0] for frame in stack)
+        name, started, child_time = stack.pop()
+        elapsed = time.perf_counter() - started
+        if stack:
+            stack[-1][2] += elapsed
+        self.profiler._record_stage(path, elapsed, elapsed - child_time)
+        return False
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class RequestProfiler:
+    """Samples a fraction of requests with cProfile for a bounded time window
+
+    While inactive every hook is a single attribute check. While active at most
+    one request is profiled at a time and at most `max_requests` are sampled.
+    """
+
+    MAX_WINDOW_SECONDS = 600
+    MAX_SAMPLED_REQUESTS = 1000
+    TOP_FUNCTIONS = 25
+
+    def __init__(self):
+        self.active = False
+        self._lock = threading.Lock()
+        self._slot = threading.Lock()
+        self._local = threading.local()
+        self._reset(0, 0, 0)
+
+    def _reset(self, sample_rate, duration, max_requests):
+        self.sample_rate = sample_rate
+        self.max_requests = max_requests
+        self.started_at = time.time()
+        self.expires_at = self.started_at + duration
+        self.sampled_requests = 0
+        self.skipped_busy = 0
+        self.stages = {}
+        self.stats = None
+
+    def start(self, sample_rate=0.1, duration=60, max_requests=100):
+        sample_rate = float(sample_rate)
+        duration = float(duration)
+        if not (math.isfinite(sample_rate) and math.isfinite(duration)):
+            raise ValueError("sample_rate and duration must be finite numbers")
+        sample_rate = min(max(sample_rate, 0.0), 1.0)
+        duration = min(max(duration, 1.0), self.MAX_WINDOW_SECONDS)
+        max_requests = min(max(int(max_requests), 1), self.MAX_SAMPLED_REQUESTS)
+        with self._lock:
+            self._reset(sample_rate, duration, max_requests)
+            self.active = True
+        logger.info(f"Profiling started: rate={sample_rate}, window={duration}s, max={max_requests} requests")
+
+    def stop(self):
+        with self._lock:
+            self.active = False
+        logger.info(f"Profiling stopped after {self.sampled_requests} sampled requests")
+
+    def _expire_if_due(self):
+        if self.active and (time.time() >= self.expires_at or self.sampled_requests >= self.max_requests):
+            self.active = False
+            logger.info(f"Profiling window closed after {self.sampled_requests} sampled requests")
+
+    def profile_request(self, name):
+        """Decorator sampling calls of a Flask view"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.active:
+                    return func(*args, **kwargs)
+                return self._run_sampled(name, func, args, kwargs)
+            return wrapper
+        return decorator
+
+    def _run_sampled(self, name, func, args, kwargs):
+        self._expire_if_due()
+        if not self.active or random.random() >= self.sample_rate:
+            return func(*args, **kwargs)
+        if not self._slot.acquire(blocking=False):
+            with self._lock:
+                self.skipped_busy += 1
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            self._local.stack = []
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is attached to the interpreter, keep stage timings only
+                profile = None
+            try:
+                with _ProfileStage(self, name):
+                    return func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                self._local.stack = None
+                self._record_profile(profile)
+        finally:
+            self._slot.release()
+
+    def stage(self, name):
+        """Context manager timing a stage of the current sampled request"""
+        if not self.active or not getattr(self._local, 'stack', None):
+            return _NULL_STAGE
+        return _ProfileStage(self, name)
+
+    def _record_stage(self, path, elapsed, self_time):
+        with self._lock:
+            stage = self.stages.setdefault(path, {"count": 0, "total": 0.0, "self": 0.0, "max": 0.0})
+            stage["count"] += 1
+            stage["total"] += elapsed
+            stage["self"] += self_time
+            stage["max"] = max(stage["max"], elapsed)
+
+    def _record_profile(self, profile):
+        with self._lock:
+            self.sampled_requests += 1
+            if profile is None:
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def pstats_dump(self):
+        """Aggregated profile in the binary format read by pstats.Stats"""
+        with self._lock:
+            return marshal.dumps(self.stats.stats) if self.stats else None
+
+    def collapsed_stacks(self):
+        """Stage self times in microseconds, in the folded format used by flame graph tools"""
+        with self._lock:
+            return "".join(
+                f"{path} {int(stage['self'] * 1e6)}\n" for path, stage in sorted(self.stages.items())
+            )
+
+    def summary(self):
+        self._expire_if_due()
+        with self._lock:
+            stages = {
+                path: {
+                    "count": stage["count"],
+                    "total_ms": round(stage["total"] * 1000, 3),
+                    "self_ms": round(stage["self"] * 1000, 3),
+                    "avg_ms": round(stage["total"] * 1000 / stage["count"], 3),
+                    "max_ms": round(stage["max"] * 1000, 3)
+                }
+                for path, stage in self.stages.items()
+            }
+
+            top_functions = []
+            if self.stats:
+                entries = sorted(self.stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+                for (filename, line, function), (_, calls, total, cumulative, _) in entries[:self.TOP_FUNCTIONS]:
+                    top_functions.append({
+                        "function": f"{filename}:{line}({function})",
+                        "calls": calls,
+                        "tottime_ms": round(total * 1000, 3),
+                        "cumtime_ms": round(cumulative * 1000, 3)
+                    })
+
+            return {
+                "active": self.active,
+                "sample_rate": self.sample_rate,
+                "max_requests": self.max_requests,
+                "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+                "expires_at": datetime.fromtimestamp(self.expires_at).isoformat(),
+                "sampled_requests": self.sampled_requests,
+                "skipped_busy": self.skipped_busy,
+                "stages": stages,
+                "top_functions": top_functions
+            }
+
+profiler = RequestProfiler()
+
+def profiled_stage(name):
+    """Decorator attributing a function's time to a named profiling stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.active:
+                return func(*args, **kwargs)
+            with profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def load_known_faces_from_file():
     """Load known faces from JSON file if it exists"""
     global KNOWN_FACES
@@ -42,13 +522,20 @@ def load_known_faces_from_file():
         if os.path.exists("known_faces.json"):
             with open("known_faces.json", "r") as f:
                 data = json.load(f)
-                # Convert lists back to numpy arrays
+                # Convert lists back to numpy arrays, or pack them into the quantized gallery
                 for person_id, person_data in data.items():
                     KNOWN_FACES[person_id] = {
                         "name": person_data["name"],
-                        "confidence_threshold": person_data["confidence_threshold"],
-                        "face_encodings": [np.array(encoding) for encoding in person_data["face_encodings"]]
+                        "confidence_threshold": person_data["confidence_threshold"]
                     }
+                    if QUANTIZED_GALLERY is None:
+                        KNOWN_FACES[person_id]["face_encodings"] = [np.array(encoding) for encoding in person_data["face_encodings"]]
+                
+                if QUANTIZED_GALLERY is not None:
+                    QUANTIZED_GALLERY.load([
+                        (person_id, person_data["confidence_threshold"], person_data["face_encodings"])
+                        for person_id, person_data in data.items()
+                    ])
                 logger.info(f"Loaded {len(KNOWN_FACES)} known faces from file")
         else:
             logger.info("No known_faces.json file found, starting with empty database")
@@ -63,16 +550,27 @@ def save_known_faces_to_file():
     try:
         # Convert numpy arrays to lists for JSON serialization
         serializable_faces = {}
+        saved_rows = read_saved_float_encodings() if QUANTIZED_GALLERY is not None else None
+        quantized_rows = {}
         for person_id, data in KNOWN_FACES.items():
+            if QUANTIZED_GALLERY is not None:
+                # The quantized gallery is only an in-memory view, write back its float originals
+                rows = QUANTIZED_GALLERY.float_rows(person_id, saved_rows.get(person_id, []))
+                quantized_rows[person_id] = rows
+            else:
+                rows = data.get("face_encodings", [])
             serializable_faces[person_id] = {
                 "name": data["name"],
                 "confidence_threshold": data["confidence_threshold"],
-                "face_encodings": [encoding.tolist() for encoding in data["face_encodings"]]
+                "face_encodings": [encoding.tolist() for encoding in rows]
             }
         
         with open("known_faces.json", "w") as f:
             json.dump(serializable_faces, f, indent=2)
         
+        for person_id, rows in quantized_rows.items():
+            QUANTIZED_GALLERY.mark_saved(person_id, rows)
+        
         logger.info(f"Saved {len(KNOWN_FACES)} known faces to known_faces.json")
         return True
         
@@ -89,6 +587,7 @@ class ImageProcessor:
         # Load known faces (in production, load from database)
         self.known_faces = KNOWN_FACES
         
+    @profiled_stage('process_image')
     def process_image(self, image_data, gate_number):
         """Process ESP32-CAM image and return analysis results"""
         try:
@@ -112,17 +611,19 @@ class ImageProcessor:
             logger.error(f"Error processing image: {str(e)}")
             return {"error": str(e), "hasFace": False, "confidence": 0}
     
+    @profiled_stage('analyze_image')
     def analyze_image(self, image, gate_number):
         """Analyze image for faces and threats"""
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         
         # Detect faces
-        faces = self.face_cascade.detectMultiScale(
-            gray, 
-            scaleFactor=1.1, 
-            minNeighbors=5, 
-            minSize=(30, 30)
-        )
+        with profiler.stage('detect_faces'):
+            faces = self.face_cascade.detectMultiScale(
+                gray, 
+                scaleFactor=1.1, 
+                minNeighbors=5, 
+                minSize=(30, 30)
+            )
         
         analysis = {
             "hasFace": len(faces) > 0,
@@ -141,7 +642,8 @@ class ImageProcessor:
                 face_roi = gray[y:y+h, x:x+w]
                 
                 # Detect eyes for better face validation
-                eyes = self.eye_cascade.detectMultiScale(face_roi)
+                with profiler.stage('detect_eyes'):
+                    eyes = self.eye_cascade.detectMultiScale(face_roi)
                 
                 # Calculate confidence based on face size and eye detection
                 face_area = w * h
@@ -171,6 +673,7 @@ class ImageProcessor:
         
         return analysis
     
+    @profiled_stage('identify_person')
     def identify_person(self, face_roi, confidence):
         """Identify if person is known using trained data"""
         if not KNOWN_FACES or confidence < 40:  # Further lowered threshold for better detection
@@ -184,6 +687,9 @@ class ImageProcessor:
         best_match = None
         best_confidence = 0
         
+        if QUANTIZED_GALLERY is not None:
+            best_match, best_confidence = self.match_quantized_gallery(face_features)
+        
         for person_id, person_data in KNOWN_FACES.items():
             if 'face_encodings' in person_data and person_data['face_encodings']:
                 # Calculate similarity with stored encodings
@@ -207,6 +713,18 @@ class ImageProcessor:
             logger.info(f"❌ No match found (best confidence: {best_confidence:.3f} < 0.5)")
             return None
     
+    @profiled_stage('match_quantized_gallery')
+    def match_quantized_gallery(self, face_features):
+        """Score face features against the whole quantized gallery at once"""
+        similarities = QUANTIZED_GALLERY.person_similarities(face_features)
+        matches = similarities > QUANTIZED_GALLERY.thresholds
+        if not matches.any():
+            return None, 0
+        
+        best = int(np.argmax(np.where(matches, similarities, -np.inf)))
+        return KNOWN_FACES[QUANTIZED_GALLERY.person_ids[best]]['name'], float(similarities[best])
+    
+    @profiled_stage('extract_face_features')
     def extract_face_features(self, face_roi):
         """Extract features from face ROI for comparison"""
         # Simple feature extraction - in production use proper face encodings
@@ -219,16 +737,17 @@ class ImageProcessor:
         features = []
         
         # Histogram features
-        hist = cv2.calcHist([face_resized], [0], None, [32], [0, 256])
+        hist = cv2.calcHist([face_resized], [0], None, [FACE_INTENSITY_BINS], [0, 256])
         features.extend(hist.flatten())
         
         # Edge features
         edges = cv2.Canny(face_resized, 50, 150)
-        edge_hist = cv2.calcHist([edges], [0], None, [16], [0, 256])
+        edge_hist = cv2.calcHist([edges], [0], None, [FACE_EDGE_BINS], [0, 256])
         features.extend(edge_hist.flatten())
         
         return np.array(features, dtype=np.float32)
     
+    @profiled_stage('calculate_face_similarity')
     def calculate_face_similarity(self, features1, stored_encodings):
         """Calculate similarity between face features"""
         if not stored_encodings:
@@ -254,6 +773,7 @@ class ImageProcessor:
         
         return max(similarities) if similarities else 0
     
+    @profiled_stage('assess_image_quality')
     def assess_image_quality(self, image):
         """Assess image quality"""
         # Calculate image sharpness using Laplacian variance
@@ -307,6 +827,7 @@ def health_check():
     })
 
 @app.route('/process-image', methods=['POST'])
+@profiler.profile_request('process-image')
 def process_image():
     """Main endpoint for processing ESP32-CAM images"""
     try:
@@ -348,6 +869,7 @@ def process_image():
         logger.error(f"Error in process_image: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@profiled_stage('send_to_main_website')
 def send_to_main_website(analysis, gate_number, floor, image_data, person_name=None):
     """Send analysis results to main website"""
     try:
@@ -475,17 +997,13 @@ def train_face():
         if person_id not in KNOWN_FACES:
             KNOWN_FACES[person_id] = {
                 "name": person_name,
-                "confidence_threshold": 0.8,
-                "face_encodings": []
+                "confidence_threshold": 0.8
             }
         
-        KNOWN_FACES[person_id]["face_encodings"].append(face_features)
-        
         # Limit to 5 encodings per person
-        if len(KNOWN_FACES[person_id]["face_encodings"]) > 5:
-            KNOWN_FACES[person_id]["face_encodings"] = KNOWN_FACES[person_id]["face_encodings"][-5:]
+        add_face_encoding(person_id, face_features, limit=5)
         
-        logger.info(f"Trained face for {person_name} - {len(KNOWN_FACES[person_id]['face_encodings'])} encodings")
+        logger.info(f"Trained face for {person_name} - {face_encoding_count(person_id)} encodings")
         
         # Save updated known faces to file
         save_known_faces_to_file()
@@ -494,7 +1012,7 @@ def train_face():
             "status": "success",
             "message": f"Face trained for {person_name}",
             "person_id": person_id,
-            "encodings_count": len(KNOWN_FACES[person_id]["face_encodings"])
+            "encodings_count": face_encoding_count(person_id)
         })
         
     except Exception as e:
@@ -510,7 +1028,7 @@ def get_known_faces():
             faces_list.append({
                 "id": person_id,
                 "name": data["name"],
-                "encodings_count": len(data.get("face_encodings", [])),
+                "encodings_count": face_encoding_count(person_id),
                 "confidence_threshold": data.get("confidence_threshold", 0.8)
             })
         
@@ -524,6 +1042,65 @@ def get_known_faces():
         logger.error(f"Error getting known faces: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def require_profiling_admin():
+    """Return an error response unless the request carries the profiling admin token"""
+    if not PROFILING_ADMIN_TOKEN:
+        return jsonify({"error": "Profiling is disabled"}), 404
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token.encode(), PROFILING_ADMIN_TOKEN.encode()):
+        return jsonify({"error": "Admin token required"}), 403
+    return None
+
+@app.route('/admin/profiling/start', methods=['POST'])
+def start_profiling():
+    """Start sampling /process-image requests"""
+    denied = require_profiling_admin()
+    if denied:
+        return denied
+    try:
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"error": "Profiling options must be a JSON object"}), 400
+        profiler.start(
+            sample_rate=data.get('sample_rate', 0.1),
+            duration=data.get('duration', 60),
+            max_requests=data.get('max_requests', 100)
+        )
+        return jsonify({"status": "success", "profiling": profiler.summary()})
+        
+    except (TypeError, ValueError, OverflowError) as e:
+        return jsonify({"error": f"Invalid profiling options: {e}"}), 400
+
+@app.route('/admin/profiling/stop', methods=['POST'])
+def stop_profiling():
+    """Stop sampling and keep the collected profile"""
+    denied = require_profiling_admin()
+    if denied:
+        return denied
+    profiler.stop()
+    return jsonify({"status": "success", "profiling": profiler.summary()})
+
+@app.route('/admin/profiling', methods=['GET'])
+def get_profiling():
+    """Return the aggregated profile as a JSON summary, pstats dump or folded stacks"""
+    denied = require_profiling_admin()
+    if denied:
+        return denied
+    
+    output_format = request.args.get('format', 'json')
+    if output_format == 'pstats':
+        dump = profiler.pstats_dump()
+        if dump is None:
+            return jsonify({"error": "No profile collected"}), 404
+        return Response(dump, mimetype='application/octet-stream',
+                        headers={"Content-Disposition": "attachment; filename=process-image.pstats"})
+    if output_format == 'collapsed':
+        return Response(profiler.collapsed_stacks(), mimetype='text/plain')
+    if output_format != 'json':
+        return jsonify({"error": "format must be json, pstats or collapsed"}), 400
+    
+    return jsonify({"status": "success", "profiling": profiler.summary()})
+
 @app.route('/evacuation-update', methods=['POST'])
 def update_evacuation():
     """Update evacuation routes based on ML analysis"""
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Compare face matching on a quantized gallery against the float encodings in known_faces.json
+"""
+
+import argparse
+import json
+import numpy as np
+
+from flask_image_processor import QuantizedGallery, float_gallery_memory_bytes, processor
+
+# Relative noise levels used to build perturbed probes for the quantization report
+REPORT_PERTURBATION_LEVELS = (0.05, 0.15, 0.3)
+REPORT_NEAR_THRESHOLD_MARGIN = 0.05
+DEFAULT_MAX_PROBES = 500
+
+def build_quantization_report(mode, max_probes=DEFAULT_MAX_PROBES):
+    """Compare match decisions of a quantized gallery against the float computation
+
+    The float encodings in known_faces.json are the baseline. Each stored
+    encoding is used as a leave-one-out probe (its own row removed from the
+    gallery) and, with multiplicative noise, as perturbed probes against the
+    full gallery, so decisions close to the thresholds are exercised too.
+    Probes are scored once per person with calculate_face_similarity and once
+    against the whole gallery packed and quantized in `mode`. At most
+    `max_probes` probes are scored, sampled at random.
+    """
+    with open("known_faces.json", "r") as f:
+        data = json.load(f)
+    float_gallery = {
+        person_id: [np.array(encoding) for encoding in person_data["face_encodings"]]
+        for person_id, person_data in data.items()
+        if person_data["face_encodings"]
+    }
+    thresholds = {person_id: data[person_id].get('confidence_threshold', 0.5) for person_id in float_gallery}
+    gallery = QuantizedGallery(mode)
+    gallery.load([(person_id, thresholds[person_id], encodings) for person_id, encodings in float_gallery.items()])
+
+    rng = np.random.default_rng(0)
+    probes = []
+    for probe_owner, encodings in float_gallery.items():
+        for index, encoding in enumerate(encodings):
+            probes.append(("leave_one_out", probe_owner, encoding, index))
+            for noise in REPORT_PERTURBATION_LEVELS:
+                perturbed = np.maximum(encoding * (1 + rng.normal(0, noise, encoding.shape)), 0)
+                probes.append(("perturbed", probe_owner, perturbed, None))
+    if len(probes) > max_probes:
+        probes = [probes[i] for i in sorted(rng.choice(len(probes), max_probes, replace=False))]
+
+    totals = {}
+    near_threshold = 0
+    max_error = 0.0
+    mismatches = []
+
+    for kind, probe_owner, probe, excluded in probes:
+        probe = probe.astype(np.float32)
+        kind_totals = totals.setdefault(kind, {"probes": 0, "identity": 0, "pairs": 0, "pair_agreements": 0})
+        float_best, float_score = None, 0
+        compact_best, compact_score = None, 0
+
+        excluded_row = gallery.row_index(probe_owner, excluded) if excluded is not None else None
+        compact_similarities = gallery.person_similarities(probe, excluded_row)
+
+        for p, person_id in enumerate(gallery.person_ids):
+            encodings = float_gallery[person_id]
+            if person_id == probe_owner and excluded is not None:
+                encodings = encodings[:excluded] + encodings[excluded + 1:]
+                if not encodings:
+                    continue
+
+            threshold = thresholds[person_id]
+            float_similarity = float(processor.calculate_face_similarity(probe, encodings))
+            compact_similarity = float(compact_similarities[p])
+            max_error = max(max_error, abs(float_similarity - compact_similarity))
+            near_threshold += int(abs(float_similarity - threshold) <= REPORT_NEAR_THRESHOLD_MARGIN)
+
+            float_match = float_similarity > threshold
+            compact_match = compact_similarity > threshold
+            kind_totals["pairs"] += 1
+            kind_totals["pair_agreements"] += int(float_match == compact_match)
+
+            if float_match and float_similarity > float_score:
+                float_best, float_score = person_id, float_similarity
+            if compact_match and compact_similarity > compact_score:
+                compact_best, compact_score = person_id, compact_similarity
+
+        # Same final decision rule as identify_person
+        float_best = float_best if float_score > 0.5 else None
+        compact_best = compact_best if compact_score > 0.5 else None
+        kind_totals["probes"] += 1
+        if float_best == compact_best:
+            kind_totals["identity"] += 1
+        else:
+            mismatches.append({
+                "probe": kind,
+                "probe_person": probe_owner,
+                "float_match": float_best,
+                "quantized_match": compact_best
+            })
+
+    # Memory actually held by each layout, including array and list headers
+    float_bytes = float_gallery_memory_bytes(float_gallery)
+    compact_bytes = gallery.memory_bytes()
+    probe_count = sum(kind_totals["probes"] for kind_totals in totals.values())
+    pair_count = sum(kind_totals["pairs"] for kind_totals in totals.values())
+
+    return {
+        "mode": mode,
+        "people": len(float_gallery),
+        "encodings": int(gallery.counts.sum()),
+        "probes": probe_count,
+        "pair_decisions": pair_count,
+        "near_threshold_pairs": near_threshold,
+        "pair_agreement": (
+            sum(kind_totals["pair_agreements"] for kind_totals in totals.values()) / pair_count
+            if pair_count else 1.0
+        ),
+        "identity_agreement": (
+            sum(kind_totals["identity"] for kind_totals in totals.values()) / probe_count
+            if probe_count else 1.0
+        ),
+        "by_probe": {
+            kind: {
+                "probes": kind_totals["probes"],
+                "pair_agreement": kind_totals["pair_agreements"] / kind_totals["pairs"] if kind_totals["pairs"] else 1.0,
+                "identity_agreement": kind_totals["identity"] / kind_totals["probes"]
+            }
+            for kind, kind_totals in totals.items()
+        },
+        "max_similarity_error": max_error,
+        "mismatches": mismatches,
+        "float_memory_bytes": float_bytes,
+        "quantized_memory_bytes": compact_bytes,
+        "compression_ratio": float_bytes / compact_bytes if compact_bytes else 0
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=("int8", "float16"), default="int8")
+    parser.add_argument("--max-probes", type=int, default=DEFAULT_MAX_PROBES)
+    args = parser.parse_args()
+
+    print("🎯 Smart Building Security - Quantized Gallery Report")
+    print("=" * 50)
+
+    report = build_quantization_report(args.mode, args.max_probes)
+    print(json.dumps(report, indent=2))
+
+    print(f"\n📊 {args.mode}: identity agreement {report['identity_agreement']:.1%}, "
+          f"pair agreement {report['pair_agreement']:.1%}, "
+          f"memory {report['compression_ratio']:.1f}x smaller")